@@ -0,0 +1,230 @@
+""" Trivia Duplicate Question Detection """
+import argparse
+import hashlib
+import random
+import unicodedata
+import zlib
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Question
+
+SHINGLE_SIZE = 5
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+SIMILARITY_THRESHOLD = 0.7
+BACKFILL_BATCH_SIZE = 1000
+
+# (a * x + b) % MERSENNE_PRIME is one random hash function per signature row
+MERSENNE_PRIME = (1 << 61) - 1
+HASH_SEED = 1
+
+
+def _is_edge_punctuation(character):
+    ''' punctuation that can be dropped from either end of a word, dashes are kept as minus signs '''
+    category = unicodedata.category(character)
+    return category.startswith('P') and category != 'Pd'
+
+
+def normalize_text(text):
+    '''
+    Case fold the text, split it into words on white space and drop the
+    punctuation at either end of each word, so "The SUN?" and "the sun"
+    match but "1/2 + 1/4" and "1/2 - 1/4" do not.
+    '''
+    words = []
+    for word in unicodedata.normalize('NFKC', str(text)).casefold().split():
+        start, end = 0, len(word)
+        while start < end and _is_edge_punctuation(word[start]):
+            start += 1
+        while end > start and _is_edge_punctuation(word[end - 1]):
+            end -= 1
+        if start < end:
+            words.append(word[start:end])
+    return ' '.join(words)
+
+
+def text_hash(text):
+    ''' key of the normalized text in the exact duplicate index, None if nothing is left to compare '''
+    normalized = normalize_text(text)
+    if normalized == '':
+        return None
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def insert_unless_duplicate(question):
+    '''
+    Insert the question unless its normalized text is already in the bank,
+    return the id of the existing question if it is.
+
+    The unique constraint on questions.question_hash is the only record of
+    which questions exist, so the check is one indexed lookup and a
+    duplicate added by another process at the same time is still refused.
+    '''
+    key = text_hash(question.question)
+    if key is not None:
+        existing = Question.query.filter_by(question_hash=key).first()
+        if existing is not None:
+            return existing.id
+    question.question_hash = key
+    try:
+        question.insert()
+    except IntegrityError:
+        # another process added the same question since the lookup
+        db.session.rollback()
+        existing = Question.query.filter_by(question_hash=key).first()
+        if existing is None:
+            raise
+        return existing.id
+    return None
+
+
+def release_hash(key):
+    '''
+    Pass the hash of a deleted question on to a remaining copy of it, if any.
+
+    Copies that were in the bank before the hashes were filled in have a
+    NULL hash, so they are found by normalizing the text of those rows.
+    '''
+    if key is None:
+        return
+    if Question.query.filter_by(question_hash=key).first() is not None:
+        return
+    candidates = Question.query.filter(Question.question_hash.is_(None)).order_by(Question.id)
+    for question in candidates.yield_per(BACKFILL_BATCH_SIZE):
+        if text_hash(question.question) == key:
+            question.question_hash = key
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # the question has been added again in the meantime
+                db.session.rollback()
+            return
+
+
+def backfill_hashes():
+    '''
+    Fill in question_hash for questions added before the column existed.
+    Only the first question with each text gets the hash, later copies stay
+    NULL for the near duplicate report. Run once with: python dedup.py --backfill
+    '''
+    claimed = {key for (key,) in db.session.query(Question.question_hash)
+               .filter(Question.question_hash.isnot(None))}
+    rows = db.session.query(Question.id, Question.question) \
+        .filter(Question.question_hash.is_(None)).order_by(Question.id).all()
+    filled = 0
+    for number, (question_id, text) in enumerate(rows, 1):
+        key = text_hash(text)
+        if key is not None and key not in claimed:
+            claimed.add(key)
+            Question.query.filter_by(id=question_id).update({'question_hash': key})
+            filled += 1
+        if number % BACKFILL_BATCH_SIZE == 0:
+            db.session.commit()
+    db.session.commit()
+    print('{} question hashes filled in, {} questions left without one'.format(
+        filled, len(rows) - filled))
+    return filled
+
+
+def shingles(text):
+    ''' the set of overlapping SHINGLE_SIZE character pieces of the normalized text '''
+    text = normalize_text(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash_signature(shingle_set, hash_params):
+    ''' the smallest hash of the shingles under each of the hash functions '''
+    values = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingle_set]
+    return tuple(min((a * value + b) % MERSENNE_PRIME for value in values)
+                 for a, b in hash_params)
+
+
+def find_near_duplicates(questions, threshold=SIMILARITY_THRESHOLD):
+    '''
+    Group (id, text) pairs into clusters of near duplicate questions.
+
+    Each question gets a MinHash signature of its shingles and the signature
+    is split into NUM_BANDS bands; only questions that share a whole band are
+    compared, so the bank is never compared pair by pair. Two questions are
+    joined when their signatures agree in at least threshold of the rows,
+    which estimates the Jaccard similarity of their shingles.
+    Returns a list of clusters, each a sorted list of question ids.
+    '''
+    rng = random.Random(HASH_SEED)
+    hash_params = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+                   for _ in range(NUM_BANDS * ROWS_PER_BAND)]
+
+    signatures = {}
+    buckets = {}
+    for question_id, text in questions:
+        if normalize_text(text) == '':
+            continue
+        signature = minhash_signature(shingles(text), hash_params)
+        signatures[question_id] = signature
+        for band in range(NUM_BANDS):
+            rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+            buckets.setdefault((band, rows), []).append(question_id)
+
+    # union-find over the question ids that turn out to be similar
+    parent = {}
+
+    def find(question_id):
+        while parent.get(question_id, question_id) != question_id:
+            question_id = parent[question_id]
+        return question_id
+
+    compared = set()
+    for bucket in buckets.values():
+        for i, first in enumerate(bucket):
+            for second in bucket[i + 1:]:
+                if (first, second) in compared:
+                    continue
+                compared.add((first, second))
+                matching = sum(x == y for x, y in zip(signatures[first], signatures[second]))
+                if matching / len(hash_params) >= threshold:
+                    parent[find(second)] = find(first)
+
+    clusters = {}
+    for question_id in parent:
+        clusters.setdefault(find(question_id), set()).add(question_id)
+    for root in list(clusters):
+        clusters[root].add(root)
+    return sorted(sorted(cluster) for cluster in clusters.values())
+
+
+def report_near_duplicates():
+    ''' print each cluster of near duplicate questions for review '''
+    questions = Question.query.order_by(Question.id).all()
+    by_id = {question.id: question for question in questions}
+    clusters = find_near_duplicates((question.id, question.question) for question in questions)
+
+    for number, cluster in enumerate(clusters, 1):
+        print('Cluster {} ({} questions)'.format(number, len(cluster)))
+        for question_id in cluster:
+            question = by_id[question_id]
+            print('  {:6d} [category {}] {} -> {}'.format(
+                question.id, question.category, question.question, question.answer))
+    print('{} clusters of near duplicate questions found in {} questions'.format(
+        len(clusters), len(questions)))
+    return clusters
+
+
+# Run the batch jobs from the backend folder with:
+#   python dedup.py --backfill   (once, after adding the question_hash column)
+#   python dedup.py              (report near duplicates)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backfill', action='store_true',
+                        help='fill in question_hash for questions that do not have one')
+    args = parser.parse_args()
+
+    from flaskr import create_app
+    app = create_app()
+    with app.app_context():
+        if args.backfill:
+            backfill_hashes()
+        else:
+            report_near_duplicates()
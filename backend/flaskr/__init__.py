@@ -1,4 +1,5 @@
 """ Trivia App Backend """
+import atexit
 import os
 import random
 import urllib
@@ -7,8 +8,13 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 
 from models import setup_db, Question, Category
+from leaderboard import Leaderboard, SCORE_BATCH_SIZE, SCORE_FLUSH_SECONDS, ALL_CATEGORIES, OVERALL
+from dedup import insert_unless_duplicate, release_hash
 
 QUESTIONS_PER_PAGE = 10
+SCORES_PER_PAGE = 10
+# the scores table uses 4 byte integers
+MAX_SCORE = 2147483647
 MIN_DIFFICULTY = 1
 MAX_DIFFICULTY = 5
 
@@ -42,6 +48,20 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
 
+    # scores are ranked in memory and written to the database in batches
+    config = test_config or {}
+    leaderboard = Leaderboard(
+        app,
+        batch_size=config.get('SCORE_BATCH_SIZE', SCORE_BATCH_SIZE),
+        flush_seconds=config.get('SCORE_FLUSH_SECONDS', SCORE_FLUSH_SECONDS)
+    )
+
+    @atexit.register
+    def flush_scores():
+        """ write any scores still waiting in a batch when the server stops """
+        with app.app_context():
+            leaderboard.flush()
+
     @app.route('/')
     def index():
         """ Home page of the API """
@@ -125,15 +145,24 @@ def create_app(test_config=None):
         if question is None:
             abort(404, description="Question ID does not exist.")
 
+        # read this before the delete expires the question's attributes
+        deleted_hash = question.question_hash
         try:
             question.delete()
-            return jsonify({
-                "success": True,
-                "deleted": question_id
-            })
         except:
             abort(422)
 
+        # the question is gone, so a failure here is only logged
+        try:
+            release_hash(deleted_hash)
+        except:
+            app.logger.exception("Could not pass on the hash of deleted question %s.", question_id)
+
+        return jsonify({
+            "success": True,
+            "deleted": question_id
+        })
+
     # TEST: When you click the trash icon next to a question, the question will be removed.
     #  This removal will persist in the database and when you refresh the page.
 
@@ -170,13 +199,17 @@ def create_app(test_config=None):
                 difficulty = difficulty,
                 category = category
             )
-            question.insert()
-            return jsonify({
-                "success": True
-            })
+            duplicate_id = insert_unless_duplicate(question)
         except:
             abort(422, "Unexpected error accessing the database.")
 
+        if duplicate_id is not None:
+            abort(422, description="That question already exists (question ID {}).".format(duplicate_id))
+
+        return jsonify({
+            "success": True
+        })
+
     # TEST: When you submit a question on the "Add" tab,
     #  the form will clear and the question will appear at the end of the last page
     #  of the questions list in the "List" tab.
@@ -302,6 +335,75 @@ def create_app(test_config=None):
     #  one question at a time is displayed, the user is allowed to answer
     #  and shown whether they were correct or not.
 
+    @app.route('/scores', methods=['POST'])
+    def post_score():
+        """ record a player's quiz score and return its rank """
+        try:
+            player = request.json.get('player')
+            score = request.json.get('score')
+            category = request.json.get('category')
+        except:
+            abort(422, description="player, score and category must be supplied.")
+
+        # check that all fields have been submitted
+        if player is None or score is None or category is None:
+            abort(422, description="player, score and category must be supplied.")
+        if player == '' or score == '' or category == '':
+            abort(422, description="None of the fields may be blank.")
+        if not isinstance(player, str) or player.strip() == '':
+            abort(422, description="The player must be a name.")
+        try:
+            score = int(score)
+            category = int(category)
+        except (TypeError, ValueError):
+            abort(422, description="The score and category must be whole numbers.")
+        if score < 0 or score > MAX_SCORE:
+            abort(422, description="The score must be between 0 and {}.".format(MAX_SCORE))
+        # category 0 is a quiz played across all categories
+        if category != ALL_CATEGORIES and Category.query.get(category) is None:
+            abort(422, description="The category specified does not exist.")
+
+        try:
+            ranks = leaderboard.add(player, category, score)
+        except:
+            abort(422, description="Unexpected error accessing the database.")
+
+        return jsonify({
+            'success': True,
+            'rank': ranks['rank'],
+            'category_rank': ranks['category_rank']
+        })
+
+    def retrieve_leaderboard_page(category):
+        """ format one page of the leaderboard for a category """
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(404, description="There are no scores on that page.")
+        try:
+            scores, total_scores = leaderboard.page(category, page, SCORES_PER_PAGE)
+        except:
+            abort(422, description="Unexpected error accessing the database.")
+
+        if len(scores) == 0:
+            abort(404, description="There are no scores on that page.")
+
+        return jsonify({
+            'success': True,
+            'scores': scores,
+            'total_scores': total_scores,
+            'current_category': category
+        })
+
+    @app.route('/leaderboard')
+    def retrieve_leaderboard():
+        """ Retrieve a page of the best scores across all quizzes """
+        return retrieve_leaderboard_page(OVERALL)
+
+    @app.route('/categories/<int:category_id>/leaderboard')
+    def retrieve_leaderboard_by_category(category_id):
+        """ Retrieve a page of the best scores for quizzes in a category (0 for quizzes across all categories) """
+        return retrieve_leaderboard_page(category_id)
+
     # @TODO: DONE Create error handlers for all expected errors including 404 and 422.
     @app.errorhandler(400)
     def not_found_error_json(error):
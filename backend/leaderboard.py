@@ -0,0 +1,183 @@
+""" Trivia Leaderboard """
+import bisect
+import itertools
+import threading
+import time
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from models import db, Score
+
+SCORE_BATCH_SIZE = 50
+SCORE_FLUSH_SECONDS = 5
+# while the database cannot be reached the retry delay doubles up to this
+MAX_RETRY_SECONDS = 300
+# scores held in memory waiting for the database before new ones are refused
+MAX_PENDING_SCORES = 10000
+# quizzes played across all categories are recorded with category 0
+ALL_CATEGORIES = 0
+# key of the board that ranks every score, whatever the category
+OVERALL = None
+
+
+class Leaderboard:
+    '''
+    Ranked quiz scores, overall and per category.
+
+    Every score is kept in memory in a list sorted best first, so a rank
+    is a binary search and a page of the leaderboard is a slice; the
+    scores table is only read once, when the first request needs it.
+    New scores are written to the database in batches of batch_size, or
+    flush_seconds after the first score of a batch arrives if that is
+    sooner (None leaves the batch until it fills or flush() is called).
+    '''
+
+    def __init__(self, app, batch_size=SCORE_BATCH_SIZE, flush_seconds=SCORE_FLUSH_SECONDS,
+                 max_pending=MAX_PENDING_SCORES):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.boards = None
+        # (board entry, Score) for each score not yet in the database
+        self.pending = []
+        self.timer = None
+        self.failures = 0
+        self.retry_at = 0
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def _load(self):
+        """ build the sorted boards from the scores table """
+        if self.boards is not None:
+            return
+        rows = db.session.query(Score.player, Score.category, Score.score) \
+            .order_by(Score.score.desc(), Score.id).all()
+        # rows arrive best first so appending keeps every board sorted
+        boards = {OVERALL: []}
+        for player, category, score in rows:
+            entry = (-score, next(self.sequence), player, category)
+            boards[OVERALL].append(entry)
+            boards.setdefault(category, []).append(entry)
+        # only keep the boards once every row has been read
+        self.boards = boards
+
+    def _rank(self, board, score):
+        """ 1 + the number of strictly better scores on the board """
+        return bisect.bisect_left(board, (-score,)) + 1
+
+    def add(self, player, category, score):
+        """ record a score and return its overall and category rank """
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                raise RuntimeError("Too many scores are waiting to be written to the database.")
+            self._load()
+            entry = (-score, next(self.sequence), player, category)
+            bisect.insort(self.boards[OVERALL], entry)
+            bisect.insort(self.boards.setdefault(category, []), entry)
+
+            self.pending.append((entry, Score(player=player, category=category, score=score)))
+            if len(self.pending) >= self.batch_size and time.monotonic() >= self.retry_at:
+                self._flush()
+            else:
+                self._schedule()
+
+            return {
+                'rank': self._rank(self.boards[OVERALL], score),
+                'category_rank': self._rank(self.boards[category], score)
+            }
+
+    def _schedule(self, delay=None):
+        """ flush the pending scores once they have waited delay (default flush_seconds) """
+        if delay is None:
+            delay = self.flush_seconds
+        if self.timer is None and self.pending and delay is not None:
+            self.timer = threading.Timer(delay, self._flush_on_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _discard(self, entry):
+        """ take a score that can never be written off the boards """
+        for key in (OVERALL, entry[3]):
+            board = self.boards.get(key, [])
+            index = bisect.bisect_left(board, entry)
+            if index < len(board) and board[index] == entry:
+                del board[index]
+
+    def _flush(self):
+        """ write the pending scores to the database in one transaction """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        try:
+            db.session.add_all([score for _, score in self.pending])
+            db.session.commit()
+            self.pending = []
+            self.failures = 0
+            return
+        except (IntegrityError, DataError):
+            db.session.rollback()
+        except:
+            db.session.rollback()
+            self._back_off()
+            return
+
+        # a score in the batch was rejected, write the batch one score at a
+        # time so that one bad score cannot lose the others
+        remaining = list(self.pending)
+        while remaining:
+            entry, score = remaining[0]
+            try:
+                db.session.add(score)
+                db.session.commit()
+            except (IntegrityError, DataError):
+                db.session.rollback()
+                self.app.logger.error("Score %r could not be written to the database and was dropped.", entry)
+                self._discard(entry)
+            except:
+                # the database has gone away, keep the rest for the next flush
+                db.session.rollback()
+                self.pending = remaining
+                self._back_off()
+                return
+            remaining.pop(0)
+        self.pending = []
+        self.failures = 0
+
+    def _back_off(self):
+        """ keep the pending scores and retry after a delay that doubles on each failure """
+        self.failures += 1
+        delay = min((self.flush_seconds or SCORE_FLUSH_SECONDS) * 2 ** self.failures, MAX_RETRY_SECONDS)
+        self.retry_at = time.monotonic() + delay
+        self.app.logger.error("%d scores could not be written to the database, retrying in %d seconds.",
+                              len(self.pending), delay)
+        self._schedule(delay)
+
+    def _flush_on_timer(self):
+        """ flush a batch that has waited flush_seconds """
+        with self.app.app_context():
+            with self.lock:
+                self.timer = None
+                self._flush()
+
+    def flush(self):
+        """ write any pending scores to the database """
+        with self.lock:
+            self._flush()
+
+    def page(self, category, page, per_page):
+        """ return one page of a board and the number of scores on it """
+        with self.lock:
+            self._load()
+            board = self.boards.get(category, [])
+            start = (page - 1) * per_page
+            end = start + per_page
+            entries = [{
+                'rank': self._rank(board, -negative_score),
+                'player': player,
+                'category': entry_category,
+                'score': -negative_score
+            } for negative_score, _, player, entry_category in board[start:end]]
+            return entries, len(board)
@@ -1,6 +1,6 @@
 # pylint: skip-file
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, DateTime, Index, create_engine, func
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -32,6 +32,8 @@ class Question(db.Model):
   answer = Column(String)
   category = Column(String)
   difficulty = Column(Integer)
+  # hash of the normalized question text, see dedup.py
+  question_hash = Column(String, unique=True)
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
@@ -76,4 +78,33 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+Score
+    one completed quiz; category 0 is a quiz played across all categories
+'''
+class Score(db.Model):  
+  __tablename__ = 'scores'
+
+  id = Column(Integer, primary_key=True)
+  player = Column(String, nullable=False)
+  category = Column(Integer, nullable=False)
+  score = Column(Integer, nullable=False)
+  created = Column(DateTime, server_default=func.now())
+
+  def __init__(self, player, category, score):
+    self.player = player
+    self.category = category
+    self.score = score
+
+  def format(self):
+    return {
+      'id': self.id,
+      'player': self.player,
+      'category': self.category,
+      'score': self.score
+    }
+
+# matches the order the leaderboard reads the scores table in
+Index('ix_scores_score_id', Score.score.desc(), Score.id)
@@ -2,10 +2,14 @@
 import os
 import unittest
 import json
+from unittest import mock
+from sqlalchemy.exc import OperationalError
 from flask_sqlalchemy import SQLAlchemy
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category, Score
+from leaderboard import Leaderboard
+from dedup import find_near_duplicates, normalize_text, text_hash, backfill_hashes
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -13,7 +17,8 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        # write each score straight through so the tests can see it in the database
+        self.app = create_app({'SCORE_BATCH_SIZE': 1})
         self.client = self.app.test_client
         self.database_name = "trivia_test"
         self.database_path = "postgres://{}/{}".format('localhost:5432', self.database_name)
@@ -35,6 +40,12 @@ class TriviaTestCase(unittest.TestCase):
             "quiz_category": {"type":"Science","id":1}
         }
 
+        self.new_score = {
+            'player': 'Tester',
+            'score': 3,
+            'category': 1
+        }
+
         # binds the app to the current context
         with self.app.app_context():
             self.db = SQLAlchemy()
@@ -202,6 +213,74 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "422 Unprocessable Entity: The category specified does not exist.")
 
+    def test_put_new_question_duplicate_422(self):
+        existing = Question.query.first()
+        q = self.new_question
+        # a change of case, spacing and punctuation is still the same question
+        q['question'] = '  ' + existing.question.upper().rstrip('?') + ' !'
+        res = self.client().put('/questions', json=q)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "422 Unprocessable Entity: That question already exists (question ID {}).".format(existing.id))
+
+    def test_put_deleted_question_again(self):
+        q = self.new_question
+        q['question'] = 'Which question is deleted and then added again?'
+        res = self.client().put('/questions', json=q)
+        self.assertEqual(res.status_code, 200)
+
+        question = Question.query.filter_by(question=q['question']).one()
+        res = self.client().delete('/questions/' + str(question.id))
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().put('/questions', json=q)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+    def test_delete_question_passes_hash_to_copy(self):
+        q = self.new_question
+        q['question'] = 'Which question has a copy from before the hashes?'
+        res = self.client().put('/questions', json=q)
+        self.assertEqual(res.status_code, 200)
+        original = Question.query.filter_by(question=q['question']).one()
+
+        # a copy already in the bank has no hash
+        copy = Question(question=q['question'].upper(), answer='Copy', category='1', difficulty=1)
+        copy.insert()
+
+        res = self.client().delete('/questions/' + str(original.id))
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().put('/questions', json=q)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['message'], "422 Unprocessable Entity: That question already exists (question ID {}).".format(copy.id))
+
+    def test_backfill_hashes(self):
+        question = Question(question='Which question was added before the hashes?', answer='This one', category='1', difficulty=1)
+        question.insert()
+        self.assertEqual(question.question_hash, None)
+
+        backfill_hashes()
+        question = Question.query.get(question.id)
+        self.assertEqual(question.question_hash, text_hash(question.question))
+
+    def test_put_new_questions_with_similar_text(self):
+        # each of these normalizes to different text so none is a duplicate
+        for text in ['What is 1/2 + 1/4 of a pizza?', 'What is 1/2 - 1/4 of a pizza?',
+                     '¿Qué es el sol?', '日本の首都は?', '中国の首都は?']:
+            q = dict(self.new_question, question=text)
+            res = self.client().put('/questions', json=q)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['success'], True)
+
     def test_search_questions(self):
         s = self.new_search
         s['searchTerm'] = "what"
@@ -262,6 +341,211 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question'])
 
+    def test_post_score(self):
+        s = self.new_score
+        scores_before = Score.query.count()
+        res = self.client().post('/scores', json=s)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['rank'] >= 1)
+        self.assertTrue(data['category_rank'] >= 1)
+        self.assertEqual(Score.query.count(), scores_before + 1)
+
+    def test_post_score_negative_422(self):
+        s = self.new_score
+        s['score'] = -1
+        res = self.client().post('/scores', json=s)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "422 Unprocessable Entity: The score must be between 0 and 2147483647.")
+
+    def test_post_score_player_not_a_name_422(self):
+        s = self.new_score
+        s['player'] = {'a': 1}
+        res = self.client().post('/scores', json=s)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "422 Unprocessable Entity: The player must be a name.")
+
+    def test_post_score_category_out_of_range_7_422(self):
+        s = self.new_score
+        s['category'] = 7
+        res = self.client().post('/scores', json=s)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "422 Unprocessable Entity: The category specified does not exist.")
+
+    def test_retrieve_leaderboard(self):
+        s = self.new_score
+        s['player'] = 'Champion'
+        s['score'] = 100000
+        self.client().post('/scores', json=s)
+        res = self.client().get('/leaderboard')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['scores'][0]['rank'], 1)
+        self.assertEqual(data['scores'][0]['score'], 100000)
+        self.assertEqual(data['total_scores'], Score.query.count())
+        self.assertEqual(data['current_category'], None)
+
+    def test_retrieve_leaderboard_by_category(self):
+        s = self.new_score
+        self.client().post('/scores', json=s)
+        res = self.client().get('/categories/1/leaderboard')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['scores'])
+        for score in data['scores']:
+            self.assertEqual(score['category'], 1)
+        self.assertEqual(data['total_scores'], Score.query.filter_by(category=1).count())
+
+    def test_retrieve_leaderboard_for_all_categories_quizzes(self):
+        s = self.new_score
+        self.client().post('/scores', json=s)
+        s['category'] = 0
+        self.client().post('/scores', json=s)
+        res = self.client().get('/categories/0/leaderboard')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['current_category'], 0)
+        for score in data['scores']:
+            self.assertEqual(score['category'], 0)
+        self.assertEqual(data['total_scores'], Score.query.filter_by(category=0).count())
+
+    def test_retrieve_leaderboard_past_the_end(self):
+        res = self.client().get('/leaderboard?page=100000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "404 Not Found: There are no scores on that page.")
+
+    # The leaderboard tests use categories with no questions so that their
+    # scores are the only ones on the category board.
+    def test_leaderboard_batch_not_written_until_flush(self):
+        with self.app.app_context():
+            leaderboard = Leaderboard(self.app, batch_size=10, flush_seconds=None)
+            for score in [3, 2, 1]:
+                leaderboard.add('Batched', 1001, score)
+            self.assertEqual(Score.query.filter_by(category=1001).count(), 0)
+
+            leaderboard.flush()
+            self.assertEqual(Score.query.filter_by(category=1001).count(), 3)
+            self.assertEqual(leaderboard.pending, [])
+
+    def test_leaderboard_batch_written_when_full(self):
+        with self.app.app_context():
+            leaderboard = Leaderboard(self.app, batch_size=2, flush_seconds=None)
+            leaderboard.add('Batched', 1002, 5)
+            self.assertEqual(Score.query.filter_by(category=1002).count(), 0)
+            leaderboard.add('Batched', 1002, 6)
+            self.assertEqual(Score.query.filter_by(category=1002).count(), 2)
+
+    def test_leaderboard_tied_scores_share_a_rank(self):
+        with self.app.app_context():
+            leaderboard = Leaderboard(self.app, batch_size=10, flush_seconds=None)
+            ranks = [leaderboard.add('Player' + str(score), 1003, score)['category_rank']
+                     for score in [20, 30, 20, 10]]
+            self.assertEqual(ranks, [1, 1, 2, 4])
+
+            scores, total_scores = leaderboard.page(1003, 1, 10)
+            self.assertEqual(total_scores, 4)
+            self.assertEqual([score['score'] for score in scores], [30, 20, 20, 10])
+            self.assertEqual([score['rank'] for score in scores], [1, 2, 2, 4])
+
+    def test_leaderboard_second_page(self):
+        with self.app.app_context():
+            leaderboard = Leaderboard(self.app, batch_size=20, flush_seconds=None)
+            for score in range(1, 13):
+                leaderboard.add('Paged', 1004, score)
+
+            scores, total_scores = leaderboard.page(1004, 2, 10)
+            self.assertEqual(total_scores, 12)
+            self.assertEqual([score['score'] for score in scores], [2, 1])
+            self.assertEqual([score['rank'] for score in scores], [11, 12])
+            self.assertEqual(leaderboard.page(1004, 3, 10), ([], 12))
+
+    def test_leaderboard_failed_flush_keeps_scores(self):
+        with self.app.app_context():
+            leaderboard = Leaderboard(self.app, batch_size=10, flush_seconds=None)
+            leaderboard.add('Retried', 1005, 1)
+            leaderboard.add('Retried', 1005, 2)
+
+            database_down = OperationalError('COMMIT', {}, Exception('database down'))
+            with mock.patch.object(db.session, 'commit', side_effect=database_down):
+                leaderboard.flush()
+            self.assertEqual(len(leaderboard.pending), 2)
+            self.assertEqual(Score.query.filter_by(category=1005).count(), 0)
+
+            # a full batch waits for the retry delay instead of trying again
+            leaderboard.batch_size = 3
+            leaderboard.add('Retried', 1005, 3)
+            self.assertEqual(len(leaderboard.pending), 3)
+
+            leaderboard.flush()
+            self.assertEqual(leaderboard.pending, [])
+            self.assertEqual(Score.query.filter_by(category=1005).count(), 3)
+
+    def test_leaderboard_bad_score_dropped_from_batch(self):
+        with self.app.app_context():
+            leaderboard = Leaderboard(self.app, batch_size=10, flush_seconds=None)
+            leaderboard.add('Good', 1006, 2)
+            # the scores table does not allow a score without a player
+            leaderboard.add(None, 1006, 1)
+            leaderboard.add('Good', 1006, 3)
+
+            leaderboard.flush()
+            self.assertEqual(leaderboard.pending, [])
+            self.assertEqual(Score.query.filter_by(category=1006).count(), 2)
+            self.assertEqual(leaderboard.page(1006, 1, 10)[1], 2)
+
+    def test_leaderboard_refuses_scores_when_too_many_pending(self):
+        with self.app.app_context():
+            leaderboard = Leaderboard(self.app, batch_size=10, flush_seconds=None, max_pending=2)
+            leaderboard.add('Waiting', 1007, 1)
+            leaderboard.add('Waiting', 1007, 2)
+            with self.assertRaises(RuntimeError):
+                leaderboard.add('Waiting', 1007, 3)
+
+
+class DedupTestCase(unittest.TestCase):
+    """Tests of the duplicate question helpers that do not need the database"""
+
+    def test_normalize_text(self):
+        self.assertEqual(normalize_text("  WHAT'S the  SKY !"), "what's the sky")
+        self.assertEqual(normalize_text('¿Qué es el sol?'), 'qué es el sol')
+        self.assertEqual(normalize_text('日本の首都は?'), '日本の首都は')
+        self.assertNotEqual(normalize_text('What is 1/2 + 1/4?'), normalize_text('What is 1/2 - 1/4?'))
+
+    def test_text_hash_of_punctuation_only_is_none(self):
+        self.assertEqual(text_hash('???'), None)
+
+    def test_find_near_duplicates(self):
+        questions = [
+            (1, "What is the largest lake in Africa?"),
+            (2, "what is the LARGEST lake in africa"),
+            (3, "Who discovered penicillin?"),
+            (4, "Who discovered penicilin?"),
+            (5, "Which dung beetle was worshipped by the ancient Egyptians?"),
+            (6, "???"),
+            (7, "!!!")
+        ]
+        self.assertEqual(find_near_duplicates(questions), [[1, 2], [3, 4]])
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()